@@ -4,17 +4,43 @@ Roles: guest (restricted filter), user (full access), admin (can edit categories
 """
 
 import jwt
+import bcrypt
+import base64
+import functools
 import hashlib
+import hmac
+import orjson
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from fastapi import HTTPException, Request, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 security = HTTPBearer(auto_error=False)
 
+# Max number of validated tokens kept in memory (see AuthManager.validate_token)
+TOKEN_CACHE_SIZE = 4096
+
 
 def hash_password(password: str) -> str:
-    """Simple SHA256 hash for password comparison."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Salted bcrypt hash, suitable for the "passwordHash" field of a user in config.json."""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Check a password against a bcrypt hash (constant-time compare)."""
+    try:
+        return bcrypt.checkpw(password.encode(), password_hash.encode())
+    except ValueError:
+        # Malformed hash in config
+        return False
+
+
+@functools.lru_cache(maxsize=1)
+def _dummy_hash() -> str:
+    """Hash checked when the username is unknown, so that a failed login takes the same
+    time whether or not the user exists. Computed on first use, not at import."""
+    return hash_password("frvm-dummy-password")
 
 
 def create_token(username: str, role: str, filter_expr: str | None, secret: str, expire_hours: int) -> str:
@@ -29,15 +55,41 @@ def create_token(username: str, role: str, filter_expr: str | None, secret: str,
     return jwt.encode(payload, secret, algorithm="HS256")
 
 
-def decode_token(token: str, secret: str) -> dict | None:
-    """Decode and validate a JWT token."""
+def _b64url_decode(segment: bytes) -> bytes:
+    """Decode an unpadded base64url segment. Only its canonical encoding is accepted
+    (no padding, stray characters or non-zero unused bits): a decoded signature
+    has a single valid spelling. Raises ValueError otherwise."""
+    data = base64.b64decode(segment + b"=" * (-len(segment) % 4), altchars=b"-_", validate=True)
+    if base64.urlsafe_b64encode(data).rstrip(b"=") != segment:
+        raise ValueError("Non-canonical base64url")
+    return data
+
+
+def decode_token(token: str, secret: str | bytes) -> dict | None:
+    """Decode and validate a JWT token (HS256 only, as issued by create_token).
+    Verified directly with hmac instead of jwt.decode: it's one HMAC-SHA256
+    over "header.payload", without PyJWT's per-call key and option handling."""
+    key = secret.encode() if isinstance(secret, str) else secret
     try:
-        payload = jwt.decode(token, secret, algorithms=["HS256"])
-        return payload
-    except jwt.ExpiredSignatureError:
+        signing_input, _, signature = token.encode().rpartition(b".")
+        header, _, payload = signing_input.partition(b".")
+        if not header or not payload:
+            return None
+        expected = hmac.new(key, signing_input, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64url_decode(signature)):
+            return None
+        if orjson.loads(_b64url_decode(header)).get("alg") != "HS256":
+            return None
+        claims = orjson.loads(_b64url_decode(payload))
+    except (ValueError, AttributeError):
+        # Malformed base64 / JSON, or header not a JSON object
         return None
-    except jwt.InvalidTokenError:
+    if not isinstance(claims, dict):
         return None
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp <= time.time():
+        return None
+    return claims
 
 
 class AuthManager:
@@ -46,18 +98,45 @@ class AuthManager:
     def __init__(self, config: dict):
         auth_config = config.get("auth", {})
         self.secret = auth_config.get("jwtSecret", "default_secret_change_me")
+        self._key = self.secret.encode()  # HMAC key for decode_token
         self.expire_hours = auth_config.get("tokenExpireHours", 24)
-        self.users = auth_config.get("users", {})
+        self.users = {}
+        for name, user in auth_config.get("users", {}).items():
+            if not isinstance(user, dict) or "role" not in user or not (
+                    user.get("passwordHash") or isinstance(user.get("password"), str)):
+                print(f"Ignoring user {name!r}: needs a role and a password or passwordHash")
+                continue
+            self.users[name] = user
         self.guest_config = auth_config.get("guest", {"enabled": False, "filter": None})
+        # username -> bcrypt hash. Users may give either "passwordHash" (bcrypt)
+        # or a plaintext "password", hashed in the background at startup (see prepare_hashes).
+        self.password_hashes = {
+            name: user["passwordHash"] for name, user in self.users.items() if user.get("passwordHash")
+        }
+        # sha256(token) -> payload, for tokens that already passed decode_token
+        self._token_cache = OrderedDict()
+    
+    def prepare_hashes(self):
+        """Compute the hashes of plaintext passwords and the dummy hash ahead of the first
+        logins, which otherwise pay a bcrypt hash on top of the check. Blocking, meant for
+        a background thread: authenticate still hashes whatever is not ready yet."""
+        _dummy_hash()
+        for name, user in list(self.users.items()):
+            if name not in self.password_hashes:
+                self.password_hashes[name] = hash_password(user["password"])
     
     def authenticate(self, username: str, password: str) -> dict | None:
-        """Authenticate user and return token info if valid."""
+        """Authenticate user and return token info if valid.
+        Blocking (bcrypt): call it from a worker thread, not the event loop."""
         user = self.users.get(username)
         if not user:
+            verify_password(password, _dummy_hash())
             return None
         
-        # Direct password comparison (passwords in config are plaintext for simplicity)
-        if user["password"] != password:
+        password_hash = self.password_hashes.get(username)
+        if password_hash is None:
+            password_hash = self.password_hashes[username] = hash_password(user["password"])
+        if not verify_password(password, password_hash):
             return None
         
         token = create_token(
@@ -98,8 +177,25 @@ class AuthManager:
         }
     
     def validate_token(self, token: str) -> dict | None:
-        """Validate token and return payload."""
-        return decode_token(token, self.secret)
+        """Validate token and return payload.
+        Valid tokens are cached until their expiry, so a bearer reused on every
+        request is only decoded once. Invalid tokens are never cached."""
+        key = hashlib.sha256(token.encode()).digest()
+        cache = self._token_cache
+        payload = cache.get(key)
+        if payload is not None:
+            if payload["exp"] > time.time():
+                cache.move_to_end(key)
+                return payload
+            del cache[key]
+        
+        payload = decode_token(token, self._key)
+        if payload is None:
+            return None
+        cache[key] = payload
+        if len(cache) > TOKEN_CACHE_SIZE:
+            cache.popitem(last=False)
+        return payload
     
     def get_user_from_request(self, request: Request) -> dict | None:
         """Extract and validate user from request (cookie or header)."""
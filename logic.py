@@ -1,4 +1,10 @@
-from bitarray import bitarray
+import functools
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+from state import tail_mask
 
 """
 Boolean expression parser (electronic logic style):
@@ -31,115 +37,74 @@ Examples:
 """
 
 
-def tokenize(expr: str, categories: dict, performers: dict = None) -> list:
+# Single-character operators → token
+_OPERATORS = {'!': 'NOT', '?': 'UNSET', '+': 'OR', '.': 'AND', '(': '(', ')': ')'}
+# Tokens after which a value implies an AND
+_VALUE_END = (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')
+
+
+@functools.lru_cache(maxsize=8)
+def _compile_tokenizer(sorted_emojis: tuple, sorted_performers: tuple) -> re.Pattern:
+    """
+    Build one regex matching any token at a position.
+    Alternatives are tried in order, so operators win over emojis and
+    longer emojis / performer names (sorted by decreasing length) win over shorter ones.
+    """
+    # !@ / ?@ are "bare" unless followed by a real performer name (then it's !/? + @name)
+    real_names = "|".join(re.escape(name) for name in sorted_performers if name != '_none')
+    not_followed = f"(?!{real_names})" if real_names else ""
+    alternatives = [
+        f"(?P<EXPLICIT_NONE>!@{not_followed})",
+        f"(?P<UNSET_PERFORMER>\\?@{not_followed})",
+        r"(?P<OP>[!?+.()])",
+    ]
+    if sorted_performers:
+        alternatives.append("@(?P<PERFORMER>" + "|".join(re.escape(name) for name in sorted_performers) + ")")
+    alternatives.append(r"(?P<UNKNOWN_PERFORMER>@)")
+    if sorted_emojis:
+        alternatives.append("(?P<EMOJI>" + "|".join(re.escape(emoji) for emoji in sorted_emojis) + ")")
+    return re.compile("|".join(alternatives))
+
+
+def sort_by_len_desc(names) -> list:
+    """Names by decreasing length, as expected by tokenize() (see also State.emojis_by_len_desc)."""
+    return sorted(names, key=len, reverse=True)
+
+
+def tokenize(expr: str, sorted_emojis, sorted_performers=()) -> list:
     """
     Transform expression into tokens.
+    sorted_emojis / sorted_performers: known emojis / performer names by decreasing length,
+    so that the longest match wins (see sort_by_len_desc).
     Possible tokens: 'NOT', 'AND', 'OR', '(', ')', ('EMOJI', emoji_str), ('PERFORMER', name)
     """
-    if performers is None:
-        performers = {}
     tokens = []
     i = 0
     expr = expr.replace(" ", "")  # remove spaces
     
-    # Sort emojis by decreasing length
-    sorted_emojis = sorted(categories.keys(), key=len, reverse=True)
-    # Sort performer names by decreasing length to match longest first
     # NOTE: be careful if one performer name is a substring of another (e.g. "mae" vs "livymae")
-    sorted_performers = sorted(performers.keys(), key=len, reverse=True)
+    pattern = _compile_tokenizer(tuple(sorted_emojis), tuple(sorted_performers))
     
     while i < len(expr):
-        c = expr[i]
+        m = pattern.match(expr, i)
+        if m is None:
+            raise ValueError(f"Unknown character at position {i}: '{expr[i:][:10]}'")
+        kind = m.lastgroup
         
-        if c == '!':
-            # Check for !@ (bare) = explicit none (admin said "no performers")
-            if i + 1 < len(expr) and expr[i + 1] == '@':
-                rest = expr[i + 2:]
-                is_bare = True
-                for name in sorted_performers:
-                    if name != '_none' and rest.startswith(name):
-                        is_bare = False
-                        break
-                if is_bare:
-                    # !@ alone = EXPLICIT_NONE token
-                    if tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')):
-                        tokens.append('AND')
-                    tokens.append('EXPLICIT_NONE')
-                    i += 2  # skip !@
-                    continue
-            # Implicit AND before NOT if previous token is a value
-            if tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')):
-                tokens.append('AND')
-            tokens.append('NOT')
-            i += 1
-        elif c == '?':
-            # Check for ?@ = unset performers (not tagged yet)
-            if i + 1 < len(expr) and expr[i + 1] == '@':
-                # But only if NOT followed by a performer name (i.e. ?@ alone or ?@ at end)
-                # If followed by a known performer name, fall through to normal UNSET+@performer
-                rest = expr[i + 2:]
-                is_bare = True
-                for name in sorted_performers:
-                    if name != '_none' and rest.startswith(name):
-                        is_bare = False
-                        break
-                if is_bare:
-                    # ?@ alone = UNSET_PERFORMER token
-                    if tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')):
-                        tokens.append('AND')
-                    tokens.append('UNSET_PERFORMER')
-                    i += 2  # skip ?@
-                    continue
-            # Implicit AND before UNSET if previous token is a value
-            if tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')):
-                tokens.append('AND')
-            tokens.append('UNSET')
-            i += 1
-        elif c == '+':
-            tokens.append('OR')
-            i += 1
-        elif c == '.':
-            tokens.append('AND')
-            i += 1
-        elif c == '(':
-            # Implicit AND before ( if previous token is a value
-            if tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')):
-                tokens.append('AND')
-            tokens.append('(')
-            i += 1
-        elif c == ')':
-            tokens.append(')')
-            i += 1
-        elif c == '@':
-            # Performer token: @Name
-            # Implicit AND before @ if previous token is a value
-            if tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')):
-                tokens.append('AND')
-            i += 1  # skip @
-            found = False
-            for name in sorted_performers:
-                if expr[i:].startswith(name):
-                    tokens.append(('PERFORMER', name))
-                    i += len(name)
-                    found = True
-                    break
-            if not found:
-                raise ValueError(f"Unknown performer at position {i}: '@{expr[i:][:20]}'")
+        if kind == 'OP':
+            token = _OPERATORS[m.group()]
+        elif kind in ('EMOJI', 'PERFORMER'):
+            token = (kind, m.group(kind))
+        elif kind == 'UNKNOWN_PERFORMER':
+            raise ValueError(f"Unknown performer at position {i + 1}: '@{expr[i + 1:][:20]}'")
         else:
-            # Look for an emoji
-            found = False
-            for emoji in sorted_emojis:
-                if expr[i:].startswith(emoji):
-                    # Implicit AND if previous token is a value
-                    if tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in (')', 'EXPLICIT_NONE', 'UNSET_PERFORMER')):
-                        tokens.append('AND')
-                    tokens.append(('EMOJI', emoji))
-                    i += len(emoji)
-                    found = True
-                    break
-            
-            if not found:
-                raise ValueError(f"Unknown character at position {i}: '{expr[i:][:10]}'")
+            token = kind  # EXPLICIT_NONE (!@) or UNSET_PERFORMER (?@)
+        
+        # Implicit AND if a value follows a value
+        if token not in ('OR', 'AND', ')') and tokens and (isinstance(tokens[-1], tuple) or tokens[-1] in _VALUE_END):
+            tokens.append('AND')
+        tokens.append(token)
+        i = m.end()
     
     return tokens
 
@@ -147,11 +112,13 @@ def tokenize(expr: str, categories: dict, performers: dict = None) -> list:
 class Parser:
     """Recursive descent parser for boolean expressions."""
     
-    def __init__(self, tokens: list, categories: dict, performers: dict = None):
+    def __init__(self, tokens: list, categories: dict, performers: dict = None, n_videos: int = None):
         self.tokens = tokens
         self.pos = 0
         self.categories = categories
         self.performers = performers or {}
+        self.n_videos = n_videos
+        self._scratch = []  # owned buffers no longer in use, reused by _take()
     
     def peek(self):
         if self.pos < len(self.tokens):
@@ -165,32 +132,62 @@ class Parser:
         self.pos += 1
         return token
     
-    def parse(self) -> bitarray:
+    def parse(self) -> np.ndarray:
         """Entry point: parse the entire expression."""
-        result = self.parse_or()
+        result, owned = self.parse_or()
         if self.peek() is not None:
             raise ValueError(f"Remaining tokens: {self.tokens[self.pos:]}")
+        # NOT sets the padding bits of the last word: clear them once here.
+        # Stored bitmaps never have padding bits, so a borrowed result is left untouched.
+        if self.n_videos is not None and len(result):
+            mask = tail_mask(self.n_videos)
+            if result[-1] & ~mask:
+                result[-1] &= mask
         return result
     
-    def parse_or(self) -> bitarray:
+    # parse_* methods return (bitmap, owned). Atoms borrow the stored bitmaps
+    # (owned=False), which must never be modified; the first operator applied
+    # to a borrowed bitmap writes into a scratch buffer, later ones work in place.
+    
+    def _take(self) -> np.ndarray:
+        """Get a scratch buffer (contents undefined)."""
+        if self._scratch:
+            return self._scratch.pop()
+        return np.empty_like(next(iter(self.categories.values()))["yes"])
+    
+    def _combine(self, ufunc, left: tuple, right: tuple) -> tuple:
+        """Apply a commutative binary ufunc, reusing an owned operand as output."""
+        (a, a_owned), (b, b_owned) = left, right
+        if not a_owned and b_owned:
+            a, b = b, a
+            a_owned, b_owned = b_owned, a_owned
+        out = a if a_owned else self._take()
+        ufunc(a, b, out=out)
+        if b_owned:
+            self._scratch.append(b)
+        return out, True
+    
+    def _invert(self, operand: tuple) -> tuple:
+        bits, owned = operand
+        return np.invert(bits, out=bits if owned else self._take()), True
+    
+    def parse_or(self) -> tuple:
         """expr_or → expr_and ('+' expr_and)*"""
         left = self.parse_and()
         while self.peek() == 'OR':
             self.consume('OR')
-            right = self.parse_and()
-            left = left | right
+            left = self._combine(np.bitwise_or, left, self.parse_and())
         return left
     
-    def parse_and(self) -> bitarray:
+    def parse_and(self) -> tuple:
         """expr_and → expr_not ('.' expr_not)* | expr_not expr_not (AND implicite)"""
         left = self.parse_not()
         while self.peek() == 'AND':
             self.consume('AND')
-            right = self.parse_not()
-            left = left & right
+            left = self._combine(np.bitwise_and, left, self.parse_not())
         return left
     
-    def parse_not(self) -> bitarray:
+    def parse_not(self) -> tuple:
         """expr_not → '!' expr_not | '?' expr_not | atom"""
         if self.peek() == 'NOT':
             self.consume('NOT')
@@ -198,16 +195,15 @@ class Parser:
             if isinstance(token, tuple) and token[0] == 'EMOJI':
                 self.consume()
                 emoji = token[1]
-                return self.categories[emoji]["no"].copy()
+                return self.categories[emoji]["no"], False
             elif isinstance(token, tuple) and token[0] == 'PERFORMER':
                 # !@performer = videos that do NOT have this performer
                 self.consume()
                 name = token[1]
-                return ~self.performers[name].copy()
+                return self._invert((self.performers[name], False))
             else:
                 # NOT of a sub-expression
-                inner = self.parse_not()
-                return ~inner
+                return self._invert(self.parse_not())
         
         if self.peek() == 'UNSET':
             self.consume('UNSET')
@@ -217,20 +213,19 @@ class Parser:
                 emoji = token[1]
                 yes = self.categories[emoji]["yes"]
                 no = self.categories[emoji]["no"]
-                return ~(yes | no)
+                return self._invert(self._combine(np.bitwise_or, (yes, False), (no, False)))
             elif isinstance(token, tuple) and token[0] == 'PERFORMER':
                 # ?@performer = videos where this performer status is unset
                 # (semantically same result as !@performer since performers are binary)
                 self.consume()
                 name = token[1]
-                return ~self.performers[name].copy()
+                return self._invert((self.performers[name], False))
             else:
-                inner = self.parse_not()
-                return ~inner
+                return self._invert(self.parse_not())
         
         return self.parse_atom()
     
-    def parse_atom(self) -> bitarray:
+    def parse_atom(self) -> tuple:
         """atom → EMOJI | PERFORMER | EXPLICIT_NONE | UNSET_PERFORMER | '(' expr_or ')'"""
         token = self.peek()
         
@@ -242,40 +237,44 @@ class Parser:
         
         if token == 'EXPLICIT_NONE':
             self.consume()
-            # !@ = admin explicitly marked "no performers" → _none bitarray
+            # !@ = admin explicitly marked "no performers" → _none bitmap
             if "_none" in self.performers:
-                return self.performers["_none"].copy()
+                return self.performers["_none"], False
             # Fallback: no _none performer → no videos match
-            n = len(list(self.categories.values())[0]["yes"])
-            result = bitarray(n)
-            result.setall(0)
-            return result
+            result = self._take()
+            result.fill(0)
+            return result, True
 
         if token == 'UNSET_PERFORMER':
             self.consume()
             # ?@ = unset performers (admin hasn't tagged yet)
             # = NOT(_none OR any_real_performer)
-            n = len(list(self.categories.values())[0]["yes"])
-            tagged = bitarray(n)
-            tagged.setall(0)
+            tagged = self._take()
+            tagged.fill(0)
             for name, bits in self.performers.items():
-                tagged |= bits
-            return ~tagged
+                np.bitwise_or(tagged, bits, out=tagged)
+            return np.invert(tagged, out=tagged), True
         
         if isinstance(token, tuple) and token[0] == 'EMOJI':
             self.consume()
             emoji = token[1]
-            return self.categories[emoji]["yes"].copy()
+            return self.categories[emoji]["yes"], False
         
         if isinstance(token, tuple) and token[0] == 'PERFORMER':
             self.consume()
             name = token[1]
-            return self.performers[name].copy()
+            return self.performers[name], False
         
         raise ValueError(f"Unexpected token: {token}")
 
 
-def evaluate(expr: str, categories: dict, performers: dict = None) -> bitarray:
+# (expr, state version) -> result bitmap, most recently used last
+_EVAL_CACHE = OrderedDict()
+EVAL_CACHE_SIZE = 256
+
+
+def evaluate(expr: str, categories: dict, performers: dict = None, n_videos: int = None,
+             version: int = None, sorted_emojis=None, sorted_performers=None) -> np.ndarray:
     """
     Evaluate a boolean expression on categories and performers.
     
@@ -288,18 +287,43 @@ def evaluate(expr: str, categories: dict, performers: dict = None) -> bitarray:
     
     Args:
         expr: Expression like "🥗.!👎" or "🔥+💃" or "@Sage_bd"
-        categories: dict[emoji, {"yes": bitarray, "no": bitarray}]
-        performers: dict[name, bitarray] (optional)
+        categories: dict[emoji, {"yes": bitmap, "no": bitmap}] (packed uint64, see state.py)
+        performers: dict[name, bitmap] (optional)
+        n_videos: number of videos, used to clear the padding bits of the last word
+        version: state version (see State.version). When given, results are cached
+                 per (expr, version) and returned read-only: callers must not modify them.
+        sorted_emojis / sorted_performers: keys of categories / performers by decreasing
+                 length (State.emojis_by_len_desc / performers_by_len_desc), sorted here if omitted
     
     Returns:
-        bitarray with 1 for each matching video
+        bitmap with 1 for each matching video
     """
+    if version is not None:
+        key = (expr, version)
+        result = _EVAL_CACHE.get(key)
+        if result is not None:
+            _EVAL_CACHE.move_to_end(key)
+            return result
+    
     if not categories:
         raise ValueError("No categories loaded")
     
     if not expr.strip():
         raise ValueError("Empty expression")
     
-    tokens = tokenize(expr, categories, performers)
-    parser = Parser(tokens, categories, performers)
-    return parser.parse()
+    if sorted_emojis is None:
+        sorted_emojis = sort_by_len_desc(categories)
+    if sorted_performers is None:
+        sorted_performers = sort_by_len_desc(performers or ())
+    tokens = tokenize(expr, sorted_emojis, sorted_performers)
+    parser = Parser(tokens, categories, performers, n_videos)
+    result = parser.parse()
+    
+    if version is not None:
+        # Read-only view: result may be a stored bitmap, which must stay writable
+        result = result.view()
+        result.flags.writeable = False
+        _EVAL_CACHE[key] = result
+        if len(_EVAL_CACHE) > EVAL_CACHE_SIZE:
+            _EVAL_CACHE.popitem(last=False)
+    return result
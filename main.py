@@ -1,16 +1,19 @@
 from fastapi import FastAPI, Query, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from multiprocessing import Queue, Process
+from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import asyncio
 import random
 import subprocess
-import json
+import orjson
 import argparse
+import os
 import sys
 
-from state import State
-from writer import writer_loop
+from state import State, get_bit, popcount, sample_set_bits, set_bit, set_bits
+from writer import CommandQueue, writer_loop
 from logic import evaluate
 from utils import parse_compact_categories, parse_performers_line
 from auth import AuthManager
@@ -44,7 +47,7 @@ def load_config() -> dict:
     """Load config from data folder or return defaults."""
     if CONFIG_FILE.exists():
         try:
-            return json.loads(CONFIG_FILE.read_text(encoding="utf-8"))
+            return orjson.loads(CONFIG_FILE.read_bytes())
         except:
             pass
     return {
@@ -73,11 +76,33 @@ def load_config() -> dict:
 config = load_config()
 auth_manager = AuthManager(config)
 
+
+async def prepare_auth():
+    # Not awaited: startup doesn't wait for bcrypt
+    asyncio.get_running_loop().run_in_executor(None, auth_manager.prepare_hashes)
+
 # Base path for reverse proxy setups (e.g., "/myapp" if behind nginx at domain.com/myapp/)
 BASE_PATH = args.basepath if args.basepath is not None else config.get("basePath", "")
 
-app = FastAPI()
-queue = Queue()
+# Static part of /api/config, resolved once (categories and performers are added per request)
+CONFIG_CATEGORIES = config.get("categories", {})  # emoji -> tooltip
+PUBLIC_CONFIG = {
+    "title": config.get("title", "FRVM"),
+    "primaryColor": config.get("primaryColor", "#ff69b4"),
+    "backgroundColor": config.get("backgroundColor", "#000000"),
+    "backgrounds": config.get("backgrounds", {
+        "landscape": "/data/landscape/background.jpg",
+        "portrait": "/data/portrait/background.jpg"
+    }),
+    "guestEnabled": config.get("auth", {}).get("guest", {}).get("enabled", False),
+    "presets": config.get("presets", {}),
+    "grid": config.get("grid", {}),
+    "basePath": BASE_PATH
+}
+
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_event_handler("startup", prepare_auth)
+queue = CommandQueue()  # commands for the writer task
 
 
 def load_performers(state, data_dir: Path):
@@ -129,42 +154,76 @@ load_performers(state, DATA_DIR)
 # Special "_none" performer: marks videos as explicitly having no performers
 state.add_performer("_none")
 
+def read_video_txt(video_file: Path) -> str:
+    """Content of the .txt file next to a video ("" if there is none)."""
+    try:
+        return video_file.with_suffix(".txt").read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return ""
+
+
 # Load state from .txt files (scanning all orientation subfolders)
-for orientation, video_file in iter_all_videos():
-    # video_id includes orientation prefix: "landscape/video.mp4"
-    video_id = f"{orientation}/{video_file.name}"
-    state.add_video(video_id)
-    txt_file = video_file.with_suffix(".txt")
-    if txt_file.exists():
-        text = txt_file.read_text(encoding="utf-8")
-        if text.strip():
-            cats = parse_compact_categories(text)
-            for emoji, val in cats.items():
-                state.add_category(emoji)
-                state.extend_category(emoji)
-                idx = state.video_index[video_id]
-                state.categories[emoji]["yes"][idx] = (val == "YES")
-                state.categories[emoji]["no"][idx] = (val == "NO")
-
-            # Load performers for this video
-            perf_names = parse_performers_line(text)
-            idx = state.video_index[video_id]
-            for name in perf_names:
-                if name not in state.performers:
-                    # Handle _none or unknown performers
-                    if name == "_none":
-                        state.extend_performer(name)
-                    else:
-                        continue
-                else:
-                    state.extend_performer(name)
-                state.performers[name][idx] = True
-
-# Start writer process (writes to .txt files) — skip in readonly mode
+# 1) register every video so bitmaps are sized once
+all_videos = list(iter_all_videos())
+# video_id includes orientation prefix: "landscape/video.mp4"
+state.add_videos(f"{orientation}/{video_file.name}" for orientation, video_file in all_videos)
+
+# 2) read the .txt files in parallel (I/O bound)
+with ThreadPoolExecutor(max_workers=32) as pool:
+    texts = list(pool.map(read_video_txt, (video_file for _, video_file in all_videos)))
+
+# 3) collect video indices per category / performer, then set bits in bulk
+cat_indices = {}   # emoji -> ([yes indices], [no indices]), in order of first appearance
+perf_indices = {}  # performer name -> [indices]
+for (orientation, video_file), text in zip(all_videos, texts):
+    if not text.strip():
+        continue
+    idx = state.video_index[f"{orientation}/{video_file.name}"]
+    try:
+        video_cats = parse_compact_categories(text)
+    except ValueError as e:
+        # One bad file must not stop the server: its categories line is ignored
+        print(f"Ignoring categories of {video_file.with_suffix('.txt')}: {e}")
+        video_cats = {}
+    for emoji, val in video_cats.items():
+        yes, no = cat_indices.setdefault(emoji, ([], []))
+        (yes if val == "YES" else no).append(idx)
+
+    # Load performers for this video (unknown performers are ignored)
+    for name in parse_performers_line(text):
+        if name in state.performers:
+            perf_indices.setdefault(name, []).append(idx)
+
+for emoji, (yes, no) in cat_indices.items():
+    state.add_category(emoji)
+    set_bits(state.categories[emoji]["yes"], yes)
+    set_bits(state.categories[emoji]["no"], no)
+for name, indices in perf_indices.items():
+    set_bits(state.performers[name], indices)
+
+# Existing thumbnails (new ones are added once generated)
+for orientation in ORIENTATIONS:
+    for jpg in (DATA_DIR / orientation).glob("*.jpg"):
+        state.thumbs_present.add(f"{orientation}/{jpg.name}")
+
+# Start writer task (writes to .txt files) — skip in readonly mode
 READONLY = args.readonly
+writer_task = None
+
+
+async def start_writer():
+    global writer_task
+    writer_task = asyncio.create_task(writer_loop(state, queue, DATA_DIR))
+
+
+async def stop_writer():
+    """Write the edits still queued or pending (debounce, pass in progress), then stop the writer."""
+    queue.close()
+    await writer_task
+
 if not READONLY:
-    writer = Process(target=writer_loop, args=(state, queue, DATA_DIR))
-    writer.start()
+    app.add_event_handler("startup", start_writer)
+    app.add_event_handler("shutdown", stop_writer)
 
 
 # ---------------- Auth Endpoints ----------------
@@ -179,11 +238,12 @@ async def login(request: Request):
     except:
         raise HTTPException(status_code=400, detail="Invalid request body")
     
-    result = auth_manager.authenticate(username, password)
+    # bcrypt takes ~0.3 s per check: run it off the event loop so logins don't stall other requests
+    result = await run_in_threadpool(auth_manager.authenticate, username, password)
     if not result:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    response = JSONResponse(content=result)
+    response = ORJSONResponse(content=result)
     # Set cookie for browser-based auth
     response.set_cookie(
         key="auth_token",
@@ -202,7 +262,7 @@ async def login_as_guest():
     if not result:
         raise HTTPException(status_code=403, detail="Guest access is disabled")
     
-    response = JSONResponse(content=result)
+    response = ORJSONResponse(content=result)
     response.set_cookie(
         key="auth_token",
         value=result["token"],
@@ -216,7 +276,7 @@ async def login_as_guest():
 @app.post("/api/logout")
 async def logout():
     """Clear auth cookie."""
-    response = JSONResponse(content={"ok": True})
+    response = ORJSONResponse(content={"ok": True})
     response.delete_cookie("auth_token")
     return response
 
@@ -242,7 +302,7 @@ async def list_categories(request: Request):
     user = auth_manager.get_user_from_request(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    return list(state.categories.keys())
+    return state.category_list
 
 
 @app.post("/video/{video_id:path}/categories")
@@ -257,28 +317,29 @@ async def update_video_categories(video_id: str, categories: dict[str, str], req
         raise HTTPException(status_code=403, detail="Only admins can edit categories")
     
     # Update state in main process (for immediate reads)
-    if video_id not in state.video_index:
+    idx = state.video_index.get(video_id)
+    if idx is None:
         return {"error": "Video not found"}
-    idx = state.video_index[video_id]
     
+    known = state.categories
+    set_video_category = state.set_video_category
+    changed = False  # some category actually changed
     for emoji, val in categories.items():
-        # Ensure category exists
-        state.add_category(emoji)
-        state.extend_category(emoji)
-        
-        cat = state.categories[emoji]
-        cat["yes"][idx] = (val == "YES")
-        cat["no"][idx] = (val == "NO")
+        # Ensure category exists (existing bitmaps are grown by add_videos already)
+        if emoji not in known:
+            state.add_category(emoji)
+            state.extend_category(emoji)
         
-        # Also send to writer for persistence
-        queue.put({
-            "type": "SET",
-            "video_id": video_id,
-            "category": emoji,
-            "state": val
-        })
+        # Re-asserting the current value changes nothing: no write needed
+        if set_video_category(idx, emoji, val):
+            changed = True
     
-    queue.put({"type": "SNAPSHOT"})
+    if changed:
+        state.version += 1
+        # Also send to writer for persistence: one command per edit, the writer
+        # renders the video from state anyway
+        queue.put({"type": "SET", "video_id": video_id})
+        queue.put({"type": "SNAPSHOT", "epoch": state.version})
     return {"ok": True}
 
 
@@ -291,14 +352,7 @@ async def get_video_categories(video_id: str, request: Request):
     
     if video_id not in state.video_index:
         return {"error": "Video not found"}
-    idx = state.video_index[video_id]
-    result = {}
-    for emoji, cat in state.categories.items():
-        if cat["yes"][idx]:
-            result[emoji] = "YES"
-        elif cat["no"][idx]:
-            result[emoji] = "NO"
-    return result
+    return state.get_video_categories(video_id)
 
 
 # ---------------- Video Serving ----------------
@@ -307,8 +361,8 @@ async def get_video_categories(video_id: str, request: Request):
 app.mount("/data", StaticFiles(directory=DATA_DIR), name="data")
 
 
-def generate_thumbnail(video_path: Path, thumb_path: Path):
-    """Generate a thumbnail from the first frame of a video."""
+def generate_thumbnail(video_path: Path, thumb_path: Path) -> bool:
+    """Generate a thumbnail from the first frame of a video. Returns True on success."""
     try:
         subprocess.run([
             "ffmpeg",
@@ -318,22 +372,66 @@ def generate_thumbnail(video_path: Path, thumb_path: Path):
             "-q:v", "4",
             str(thumb_path)
         ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
     except Exception as e:
         print(f"Thumbnail generation failed for {video_path.name}: {e}")
+        return False
 
 
-def get_video_categories_dict(video_id: str) -> dict:
-    """Get categories for a video as {emoji: "YES"|"NO"}."""
-    if video_id not in state.video_index:
-        return {}
-    idx = state.video_index[video_id]
-    result = {}
-    for emoji, cat in state.categories.items():
-        if cat["yes"][idx]:
-            result[emoji] = "YES"
-        elif cat["no"][idx]:
-            result[emoji] = "NO"
-    return result
+# ffmpeg runs in its own process: threads are enough to keep several running
+thumb_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+_thumb_inflight = set()  # video ids whose thumbnail is being generated
+
+
+def queue_thumbnail(video_id: str, thumb_id: str):
+    """Generate a thumbnail in the background (once per video at a time)."""
+    if video_id in _thumb_inflight:
+        return
+    _thumb_inflight.add(video_id)
+    
+    def done(future):
+        if future.result():
+            state.thumbs_present.add(thumb_id)
+        _thumb_inflight.discard(video_id)
+    
+    thumb_executor.submit(generate_thumbnail, DATA_DIR / video_id, DATA_DIR / thumb_id).add_done_callback(done)
+
+
+def build_video_entry(idx: int) -> dict:
+    """Build the playlist entry of a video (urls, thumbnail, categories, performers)."""
+    video_id = state.index_video[idx]
+    ori = state.orient[idx]
+    thumb_name = state.name[idx].rsplit(".", 1)[0] + ".jpg"
+    thumb_id = f"{ori}/{thumb_name}" if ori else thumb_name
+    thumb_url = f"{BASE_PATH}/data/{thumb_id}"
+    
+    # Missing thumbnail: poster is null until the background generation is done
+    has_thumb = thumb_id in state.thumbs_present
+    if not has_thumb:
+        queue_thumbnail(video_id, thumb_id)
+    
+    return {
+        "id": video_id,
+        "url": f"{BASE_PATH}/data/{video_id}",
+        "poster": thumb_url if has_thumb else None,
+        "cats": state.get_video_categories(video_id),
+        "performers": state.get_video_performers(video_id)
+    }
+
+
+def evaluate_for_user(expr: str, user: dict):
+    """Bitmap of the videos matching expr and the user's forced filter (guest), None = all videos.
+    The filter is evaluated on its own, so it hits the evaluate() cache once per state version
+    whatever the expression, and only one AND is left per request."""
+    n = len(state.index_video)
+    parts = [evaluate(e, state.categories, state.performers, n, state.version,
+                      state.emojis_by_len_desc, state.performers_by_len_desc)
+             for e in (user.get("filter"), expr) if e]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    return parts[0] & parts[1]
 
 
 @app.get("/api/videos")
@@ -348,85 +446,28 @@ async def get_video_playlist(
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    all_categories = list(state.categories.keys())
+    all_categories = state.category_list
     
-    # Apply guest filter if present
-    user_filter = user.get("filter")
-    if user_filter:
-        expr = f"({user_filter}).({expr})" if expr else user_filter
-    
-    # If expression provided, filter by categories first
-    if expr:
-        bits = evaluate(expr, state.categories, state.performers)
-        matching_ids = [state.index_video[i] for i, b in enumerate(bits) if b]
-        
-        # Filter by orientation if specified
+    # If expression (or guest filter) provided, filter by categories first
+    bits = evaluate_for_user(expr, user)
+    if bits is not None:
+        # Filter by orientation if specified (before sampling)
         if orientation and orientation in ORIENTATIONS:
-            matching_ids = [vid for vid in matching_ids if vid.startswith(f"{orientation}/")]
-        
-        if not matching_ids:
-            return {"categories": all_categories, "videos": []}
+            if orientation not in state.orient_bits:
+                return {"categories": all_categories, "videos": []}
+            bits = bits & state.orient_bits[orientation]
         
-        selected_ids = random.sample(matching_ids, min(limit, len(matching_ids)))
-        
-        videos = []
-        for video_id in selected_ids:
-            video_path = DATA_DIR / video_id
-            
-            video_url = f"{BASE_PATH}/data/{video_id}"
-            thumb_file = video_path.with_suffix(".jpg")
-            thumb_url = f"{BASE_PATH}/data/{video_id}".replace(".mp4", ".jpg")
-            
-            if not thumb_file.exists():
-                generate_thumbnail(video_path, thumb_file)
-            
-            videos.append({
-                "id": video_id,
-                "url": video_url,
-                "poster": thumb_url if thumb_file.exists() else None,
-                "cats": get_video_categories_dict(video_id),
-                "performers": state.get_video_performers(video_id)
-            })
-        
-        return {"categories": all_categories, "videos": videos}
-    
-    # No expression: collect video files based on orientation filter only
-    video_files = []
-    
-    if orientation and orientation in ORIENTATIONS:
-        folder = DATA_DIR / orientation
-        if folder.exists():
-            video_files = list(folder.glob("*.mp4"))
+        selected = sample_set_bits(bits, limit)
     else:
-        for ori in ORIENTATIONS:
-            folder = DATA_DIR / ori
-            if folder.exists():
-                video_files.extend(folder.glob("*.mp4"))
+        # No expression: pick among all videos of the orientation (or all videos)
+        if orientation and orientation in ORIENTATIONS:
+            pool = state.videos_by_orientation.get(orientation, [])
+        else:
+            pool = range(len(state.index_video))
+        selected = random.sample(pool, min(limit, len(pool)))
     
-    if not video_files:
-        return {"categories": all_categories, "videos": []}
-
-    selected = random.sample(video_files, min(limit, len(video_files)))
-
-    videos = []
-    for file in selected:
-        ori = file.parent.name if file.parent.name in ORIENTATIONS else ""
-        video_id = f"{ori}/{file.name}" if ori else file.name
-        video_url = f"{BASE_PATH}/data/{ori}/{file.name}" if ori else f"{BASE_PATH}/data/{file.name}"
-        thumb_file = file.with_suffix(".jpg")
-        thumb_url = f"{BASE_PATH}/data/{ori}/{file.stem}.jpg" if ori else f"{BASE_PATH}/data/{file.stem}.jpg"
-
-        if not thumb_file.exists():
-            generate_thumbnail(file, thumb_file)
-
-        videos.append({
-            "id": video_id,
-            "url": video_url,
-            "poster": thumb_url if thumb_file.exists() else None,
-            "cats": get_video_categories_dict(video_id),
-            "performers": state.get_video_performers(video_id)
-        })
-
+    state.load_video_categories(selected)
+    videos = [build_video_entry(idx) for idx in selected]
     return {"categories": all_categories, "videos": videos}
 
 
@@ -476,17 +517,21 @@ async def update_video_performers(video_id: str, request: Request):
     idx = state.video_index[video_id]
 
     # Update state in main process (for immediate reads)
-    for name, bits in state.performers.items():
+    changed = False
+    for name in state.performers:
         state.extend_performer(name)
-        bits[idx] = (name in performers)
+        bits = state.performers[name]
+        has = name in performers
+        if get_bit(bits, idx) != has:
+            set_bit(bits, idx, has)
+            changed = True
+    if not changed:
+        return {"ok": True}
+    state.version += 1
 
     # Send to writer for persistence
-    queue.put({
-        "type": "SET_PERFORMERS",
-        "video_id": video_id,
-        "performers": performers
-    })
-    queue.put({"type": "SNAPSHOT"})
+    queue.put({"type": "SET_PERFORMERS", "video_id": video_id})
+    queue.put({"type": "SNAPSHOT", "epoch": state.version})
     return {"ok": True}
 
 
@@ -499,29 +544,19 @@ async def search_count(request: Request, expr: str = Query("", description="Bool
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    # Apply guest filter if present
-    user_filter = user.get("filter")
-    if user_filter:
-        expr = f"({user_filter}).({expr})" if expr else user_filter
+    counts = {"portrait": 0, "square": 0, "landscape": 0, "total": 0}
     
-    # Get matching video IDs
-    if expr:
-        try:
-            bits = evaluate(expr, state.categories, state.performers)
-            matching_ids = [state.index_video[i] for i, b in enumerate(bits) if b]
-        except Exception:
-            matching_ids = []
-    else:
-        matching_ids = list(state.video_index.keys())
+    # Get matching videos bitmap (None = all videos)
+    try:
+        bits = evaluate_for_user(expr, user)
+    except Exception:
+        return counts
     
-    # Count by orientation
-    counts = {"portrait": 0, "square": 0, "landscape": 0, "total": 0}
-    for vid in matching_ids:
-        for ori in ORIENTATIONS:
-            if vid.startswith(f"{ori}/"):
-                counts[ori] += 1
-                break
-        counts["total"] += 1
+    # Count by orientation: popcount of the matches within each orientation bitmap
+    for ori, ori_bits in state.orient_bits.items():
+        if ori in ORIENTATIONS:
+            counts[ori] = popcount(ori_bits if bits is None else bits & ori_bits)
+    counts["total"] = sum(counts.values())
     
     return counts
 
@@ -529,27 +564,12 @@ async def search_count(request: Request, expr: str = Query("", description="Bool
 @app.get("/api/config")
 def get_config():
     """Get public UI config (no auth required for login page)."""
-    auth_config = config.get("auth", {})
-    guest_config = auth_config.get("guest", {})
-    
     # Merge config categories (with tooltips) with actual state categories
-    config_categories = config.get("categories", {})
-    all_cats = list(state.categories.keys())
-    categories_with_tooltips = {cat: config_categories.get(cat, "") for cat in all_cats}
+    categories_with_tooltips = {cat: CONFIG_CATEGORIES.get(cat, "") for cat in state.category_list}
     
     return {
-        "title": config.get("title", "FRVM"),
-        "primaryColor": config.get("primaryColor", "#ff69b4"),
-        "backgroundColor": config.get("backgroundColor", "#000000"),
-        "backgrounds": config.get("backgrounds", {
-            "landscape": "/data/landscape/background.jpg",
-            "portrait": "/data/portrait/background.jpg"
-        }),
-        "guestEnabled": guest_config.get("enabled", False),
+        **PUBLIC_CONFIG,
         "categories": categories_with_tooltips,
-        "presets": config.get("presets", {}),
-        "grid": config.get("grid", {}),
-        "basePath": BASE_PATH,
         "performers": build_performers_info()
     }
 
@@ -1,59 +1,285 @@
-from bitarray import bitarray
+import bisect
+import random
+import sys
+
+import numpy as np
+
+# Bitmaps are packed uint64 words: video idx i is bit (i & 63) of word (i >> 6).
+# Bits past the last video are always 0 in stored bitmaps.
+_BIT = [np.uint64(1) << np.uint64(b) for b in range(64)]
+_NOT_BIT = [~m for m in _BIT]
+
+
+def n_words(n: int) -> int:
+    """Number of uint64 words needed to hold n bits."""
+    return (n + 63) >> 6
+
+
+def new_bitmap(n: int) -> np.ndarray:
+    """All-zero bitmap for n videos."""
+    return np.zeros(n_words(n), dtype=np.uint64)
+
+
+def grow_bitmap(bits: np.ndarray, n: int) -> np.ndarray:
+    """Return bits extended with zeros to hold n videos (same array if already large enough)."""
+    missing = n_words(n) - len(bits)
+    if missing <= 0:
+        return bits
+    return np.concatenate((bits, np.zeros(missing, dtype=np.uint64)))
+
+
+def get_bit(bits: np.ndarray, i: int) -> bool:
+    return bool(bits[i >> 6] & _BIT[i & 63])
+
+
+def set_bit(bits: np.ndarray, i: int, value: bool):
+    if value:
+        bits[i >> 6] |= _BIT[i & 63]
+    else:
+        bits[i >> 6] &= _NOT_BIT[i & 63]
+
+
+def set_bits(bits: np.ndarray, indices):
+    """Set the bits at the given indices (vectorized)."""
+    idx = np.asarray(indices, dtype=np.uint64)
+    np.bitwise_or.at(bits, (idx >> np.uint64(6)).astype(np.intp), np.uint64(1) << (idx & np.uint64(63)))
+
+
+if hasattr(np, "bitwise_count"):  # NumPy >= 2.0
+    def word_popcounts(bits: np.ndarray) -> np.ndarray:
+        """Number of set bits of each word."""
+        return np.bitwise_count(bits)
+
+    def popcount(bits: np.ndarray) -> int:
+        """Number of set bits in a bitmap."""
+        return int(np.bitwise_count(bits).sum())
+else:
+    _M1, _M2, _M4, _H01 = (np.uint64(m) for m in (0x5555555555555555, 0x3333333333333333,
+                                                   0x0F0F0F0F0F0F0F0F, 0x0101010101010101))
+
+    def word_popcounts(bits: np.ndarray) -> np.ndarray:
+        """Number of set bits of each word (SWAR)."""
+        x = bits - ((bits >> np.uint64(1)) & _M1)
+        x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+        x = (x + (x >> np.uint64(4))) & _M4
+        return (x * _H01) >> np.uint64(56)
+
+    def popcount(bits: np.ndarray) -> int:
+        """Number of set bits in a bitmap."""
+        return int.from_bytes(bits.tobytes(), "little").bit_count()
+
+
+def sample_set_bits(bits: np.ndarray, k: int, rng=random) -> list[int]:
+    """Pick min(k, popcount) distinct set-bit indices uniformly at random.
+    Draws k ranks among the set bits and locates them through the running
+    popcount of the words, so matching indices are never materialized."""
+    cumulative = np.cumsum(word_popcounts(bits), dtype=np.int64)
+    total = int(cumulative[-1]) if len(cumulative) else 0
+    ranks = rng.sample(range(total), min(k, total))
+    words = np.searchsorted(cumulative, ranks, side="right").tolist()
+    result = []
+    for rank, w in zip(ranks, words):
+        x = int(bits[w])
+        # Drop the lowest set bits preceding the wanted one
+        for _ in range(rank - (int(cumulative[w - 1]) if w else 0)):
+            x &= x - 1
+        result.append((w << 6) + (x & -x).bit_length() - 1)
+    return result
+
+
+# Below this many videos, load_video_categories reads the bitmaps one video at a time
+VECTORIZED_MIN_VIDEOS = 8
+
+
+def tail_mask(n: int) -> np.uint64:
+    """Mask of the valid bits in the last word of a bitmap for n videos."""
+    r = n & 63
+    return ~np.uint64(0) if r == 0 else _BIT[r] - np.uint64(1)
+
+
+def _neg_len(s: str) -> int:
+    return -len(s)
+
 
 class State:
     def __init__(self):
         self.video_index = {}  # video_id -> idx
         self.index_video = []  # idx -> video_id
-        self.categories = {}   # emoji -> {"yes": bitarray, "no": bitarray}
-        self.performers = {}   # performer_name -> bitarray (1 = video has this performer)
+        self.categories = {}   # emoji -> {"yes": bitmap, "no": bitmap}
+        self.category_list = []  # emojis in creation order (= list(categories)), ready for API responses
+        self.category_rank = {}  # emoji -> position in category_list
+        self.emojis_by_len_desc = []  # category emojis by decreasing length, for the tokenizer (see logic.py)
+        self.performers = {}   # performer_name -> bitmap (1 = video has this performer)
+        self.performers_by_len_desc = []  # performer names by decreasing length, for the tokenizer
         self.performer_info = {}  # performer_name -> {"urls": [...], "avatar": "/data/performers/X.jpg" or None}
+        self.orient_bits = {}  # orientation -> bitmap of the videos in that subfolder
+        # Per-video columns (idx -> value), split from video_id once at registration
+        self.orient = []  # orientation subfolder (interned), "" if none
+        self.name = []    # file name within the subfolder
+        self.video_cats = []  # idx -> {emoji: "YES"|"NO"}, or None until computed (see get_video_categories)
+        self.videos_by_orientation = {}  # orientation -> [idx]
+        self.thumbs_present = set()  # "orientation/name.jpg" of the existing thumbnails
+        self.version = 0  # bumped on every change to videos/categories/performers bits
 
     def add_video(self, video_id: str):
-        if video_id in self.video_index:
+        self.add_videos([video_id])
+
+    def add_videos(self, video_ids):
+        """Register several videos at once, growing every bitmap a single time."""
+        start = len(self.index_video)
+        by_orient = {}  # orientation -> new indices
+        for video_id in video_ids:
+            if video_id in self.video_index:
+                continue
+            idx = len(self.index_video)
+            self.video_index[video_id] = idx
+            self.index_video.append(video_id)
+            ori, sep, name = video_id.partition("/")
+            if not sep:
+                ori, name = "", video_id
+            ori = sys.intern(ori)
+            self.orient.append(ori)
+            self.name.append(name)
+            if ori:
+                by_orient.setdefault(ori, []).append(idx)
+                self.videos_by_orientation.setdefault(ori, []).append(idx)
+        n = len(self.index_video)
+        if n == start:
             return
-        idx = len(self.index_video)
-        self.video_index[video_id] = idx
-        self.index_video.append(video_id)
-        for cat in self.categories.values():
-            cat["yes"].append(0)
-            cat["no"].append(0)
-        for bits in self.performers.values():
-            bits.append(0)
+        self.video_cats.extend([None] * (n - start))
+        self.version += 1
+        if n_words(n) > n_words(start):
+            for cat in self.categories.values():
+                cat["yes"] = grow_bitmap(cat["yes"], n)
+                cat["no"] = grow_bitmap(cat["no"], n)
+            for name, bits in self.performers.items():
+                self.performers[name] = grow_bitmap(bits, n)
+            for ori, bits in self.orient_bits.items():
+                self.orient_bits[ori] = grow_bitmap(bits, n)
+        for ori, indices in by_orient.items():
+            if ori not in self.orient_bits:
+                self.orient_bits[ori] = new_bitmap(n)
+            set_bits(self.orient_bits[ori], indices)
 
     def add_category(self, emoji: str):
         n = len(self.index_video)
         if emoji not in self.categories:
             self.categories[emoji] = {
-                "yes": bitarray("0") * n,
-                "no": bitarray("0") * n
+                "yes": new_bitmap(n),
+                "no": new_bitmap(n),
+                # "+emoji" / "-emoji" as written in .txt files, encoded once
+                "_plus": ("+" + emoji).encode("utf-8"),
+                "_minus": ("-" + emoji).encode("utf-8")
             }
+            self.category_rank[emoji] = len(self.category_list)
+            self.category_list.append(emoji)
+            bisect.insort(self.emojis_by_len_desc, emoji, key=_neg_len)
+            self.version += 1
 
     def extend_category(self, emoji: str):
-        """Extend bitarrays if the number of videos has increased."""
+        """Extend bitmaps if the number of videos has increased."""
         n = len(self.index_video)
         cat = self.categories[emoji]
-        if len(cat["yes"]) < n:
-            cat["yes"].extend([0] * (n - len(cat["yes"])))
-            cat["no"].extend([0] * (n - len(cat["no"])))
+        cat["yes"] = grow_bitmap(cat["yes"], n)
+        cat["no"] = grow_bitmap(cat["no"], n)
 
     def add_performer(self, name: str):
-        """Register a performer (from performers/ folder). Creates bitarray if new."""
+        """Register a performer (from performers/ folder). Creates bitmap if new."""
         n = len(self.index_video)
         if name not in self.performers:
-            self.performers[name] = bitarray("0") * n
+            self.performers[name] = new_bitmap(n)
+            bisect.insort(self.performers_by_len_desc, name, key=_neg_len)
         if name not in self.performer_info:
             self.performer_info[name] = {"urls": [], "avatar": None}
 
     def extend_performer(self, name: str):
-        """Extend performer bitarray if videos have been added."""
+        """Extend performer bitmap if videos have been added."""
         n = len(self.index_video)
-        bits = self.performers[name]
-        if len(bits) < n:
-            bits.extend([0] * (n - len(bits)))
+        self.performers[name] = grow_bitmap(self.performers[name], n)
+
+    def set_video_category(self, idx: int, emoji: str, val: str) -> bool:
+        """Set category emoji of video idx to "YES", "NO" or anything else (= unset).
+        The category must exist. Returns False if the value was already that one.
+        The cached categories of the video, if any, are patched rather than recomputed."""
+        cat = self.categories[emoji]
+        yes_bits, no_bits = cat["yes"], cat["no"]
+        yes, no = val == "YES", val == "NO"
+        w, b = idx >> 6, idx & 63
+        m = _BIT[b]
+        if bool(yes_bits[w] & m) == yes and bool(no_bits[w] & m) == no:
+            return False
+        if yes:
+            yes_bits[w] |= m
+        else:
+            yes_bits[w] &= _NOT_BIT[b]
+        if no:
+            no_bits[w] |= m
+        else:
+            no_bits[w] &= _NOT_BIT[b]
+
+        cats = self.video_cats[idx]
+        if cats is not None:
+            if not (yes or no):
+                cats.pop(emoji, None)
+            elif emoji in cats or not cats or self.category_rank[next(reversed(cats))] < self.category_rank[emoji]:
+                cats[emoji] = "YES" if yes else "NO"
+            else:
+                # Keep the category order of a freshly computed dict
+                cats[emoji] = "YES" if yes else "NO"
+                self.video_cats[idx] = dict(sorted(cats.items(), key=lambda item: self.category_rank[item[0]]))
+        return True
+
+    def get_video_categories(self, video_id: str) -> dict:
+        """Get categories of a video as {emoji: "YES"|"NO"}.
+        Cached per video: whoever changes its bits must go through set_video_category
+        or reset video_cats[idx] to None.
+        The returned dict is shared, callers must not modify it."""
+        if video_id not in self.video_index:
+            return {}
+        idx = self.video_index[video_id]
+        cats = self.video_cats[idx]
+        if cats is None:
+            cats = self.video_cats[idx] = self._scan_video_categories(idx)
+        return cats
+
+    def _scan_video_categories(self, idx: int) -> dict:
+        """Categories of video idx, read from the bitmaps (word and mask computed once)."""
+        w, m = idx >> 6, _BIT[idx & 63]
+        cats = {}
+        for emoji, cat in self.categories.items():
+            if cat["yes"][w] & m:
+                cats[emoji] = "YES"
+            elif cat["no"][w] & m:
+                cats[emoji] = "NO"
+        return cats
+
+    def load_video_categories(self, indices):
+        """Compute the cached categories (see get_video_categories) of several videos at once:
+        the words holding their bits are gathered for every category in one go,
+        instead of two scalar reads per (video, category)."""
+        todo = [i for i in indices if self.video_cats[i] is None]
+        if len(todo) < VECTORIZED_MIN_VIDEOS or not self.categories:
+            # Building the matrices costs more than it saves for a few videos
+            for i in todo:
+                self.video_cats[i] = self._scan_video_categories(i)
+            return
+        idx = np.array(todo, dtype=np.uint64)
+        words = (idx >> np.uint64(6)).astype(np.intp)
+        shifts = idx & np.uint64(63)
+        # (categories, videos) matrices of bits, rows in category_list order
+        yes = (np.stack([cat["yes"][words] for cat in self.categories.values()]) >> shifts) & np.uint64(1)
+        no = (np.stack([cat["no"][words] for cat in self.categories.values()]) >> shifts) & np.uint64(1)
+        emojis = self.category_list
+        for j, i in enumerate(todo):
+            y = yes[:, j]
+            self.video_cats[i] = {
+                emojis[k]: "YES" if y[k] else "NO"
+                for k in np.flatnonzero(y | no[:, j]).tolist()
+            }
 
     def get_video_performers(self, video_id: str) -> list[str]:
         """Get list of performer names associated with a video."""
         if video_id not in self.video_index:
             return []
         idx = self.video_index[video_id]
-        return [name for name, bits in self.performers.items() if bits[idx]]
+        return [name for name, bits in self.performers.items() if get_bit(bits, idx)]
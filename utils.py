@@ -1,31 +1,23 @@
 import re
 
 
+# One "+emoji" / "-emoji" entry of a compact category line (whitespace removed)
+_COMPACT_PAT = re.compile(r"([+\-])([^+\-]+)")
+
+
 def parse_compact_categories(text: str) -> dict[str, str]:
     """Parse compact category format like '+🥗+🐈-👎' into dict.
     Only parses the first line (categories). Use parse_video_txt for full parsing."""
     # Take only first line (performers may be on second line)
-    first_line = text.split("\n")[0].strip()
-    first_line = re.sub(r"\s+", "", first_line)
-    if not first_line:
-        return {}
-    result = {}
-    i = 0
-    n = len(first_line)
-    while i < n:
-        sign = first_line[i]
-        if sign not in "+-":
-            raise ValueError(f"Invalid format at position {i}")
-        state = "YES" if sign == "+" else "NO"
-        i += 1
-        start = i
-        while i < n and first_line[i] not in "+-":
-            i += 1
-        cat = first_line[start:i]
-        if not cat:
-            raise ValueError("Empty category")
-        result[cat] = state
-    return result
+    first_line = text.partition("\n")[0]
+    # Whitespace is ignored, even inside a name ("+🥗 🐈" is category "🥗🐈")
+    compact = "".join(first_line.split())
+    entries = _COMPACT_PAT.findall(compact)
+    # Every character must belong to an entry
+    matched = sum(1 + len(cat) for _, cat in entries)
+    if matched != len(compact):
+        raise ValueError(f"Invalid format: '{first_line[:40]}'")
+    return {cat: ("YES" if sign == "+" else "NO") for sign, cat in entries}
 
 
 def parse_performers_line(text: str) -> list[str]:
@@ -1,77 +1,370 @@
+import asyncio
+import functools
 import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from utils import format_performers_line
+from writer_io_uring import IoUringWriter
 
+# Seconds to wait for more commands before writing, so a burst of edits is written once
+DEBOUNCE_SECONDS = 0.05
+# Max commands collected per pass
+MAX_BATCH = 1024
+# Seconds before writing again the videos of a pass that failed
+RETRY_SECONDS = 5
+# Threads writing the files of a pass
+WRITE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# FRVM_DURABILITY env var: "fsync" (default) syncs the files and directories of each pass
+# before the next pass starts, "flush" / "async" only hand the data to the kernel (files are
+# written unbuffered, so both are the same) and a crash may also lose what the kernel had not
+# written yet. Either way, API edits are acknowledged before the writer has seen them: a crash
+# loses the edits not yet written (debounce window, pass in progress).
+# A .txt file is replaced through a tmp file + rename, so never left half written,
+# except on DIRECT_WRITE_FILESYSTEMS where it is written in place.
+DURABILITY_MODES = ("fsync", "flush", "async")
+# Filesystems where files are written in place (no tmp file, rename or fsync):
+# nothing survives a crash on tmpfs / ramfs anyway, and s3fs uploads whole files on close
+DIRECT_WRITE_FILESYSTEMS = ("tmpfs", "ramfs", "fuse.s3fs", "s3fs")
 
-def export_video_txt(state, video_id: str, videos_dir: Path):
-    """Write categories and performers to .txt file for a single video.
+
+def render_video_txt(state, video_id: str, buf: bytearray = None) -> bytes:
+    """Content of the .txt file of a video, UTF-8 encoded.
     Line 1: categories (+emoji-emoji)
     Line 2 (optional): performers (@Name1@Name2)
+    buf: scratch buffer reused between calls (cleared here)
     """
-    idx = state.video_index[video_id]
-    
-    # Line 1: categories
-    cat_parts = []
-    for emoji, cat in state.categories.items():
-        if cat["yes"][idx]:
-            cat_parts.append(f"+{emoji}")
-        elif cat["no"][idx]:
-            cat_parts.append(f"-{emoji}")
-    
-    # Line 2: performers
-    perf_names = state.get_video_performers(video_id)
-    perf_line = format_performers_line(perf_names)
-    
-    # Build content: categories on line 1, performers on line 2 if any
-    content = "".join(cat_parts)
+    if buf is None:
+        buf = bytearray()
+    buf.clear()
+
+    # Line 1: categories ("+emoji" / "-emoji" bytes encoded once, see State.add_category)
+    categories = state.categories
+    for emoji, val in state.get_video_categories(video_id).items():
+        buf += categories[emoji]["_plus" if val == "YES" else "_minus"]
+
+    # Line 2: performers, if any
+    perf_line = format_performers_line(state.get_video_performers(video_id))
     if perf_line:
-        content += "\n" + perf_line
-    
-    # video_id can include subfolder (e.g., "landscape/video.mp4")
-    video_path = videos_dir / video_id
-    txt_path = video_path.with_suffix(".txt")
-    tmp = txt_path.with_suffix(".txt.tmp")
-    
-    with open(tmp, "w", encoding="utf-8") as f:
-        f.write(content)
-        f.flush()
-        os.fsync(f.fileno())
-    os.replace(tmp, txt_path)
-
-
-def writer_loop(state, queue, videos_dir: Path):
-    """Background process that handles state updates and writes to .txt files."""
+        buf += b"\n"
+        buf += perf_line.encode("utf-8")
+    return bytes(buf)
+
+
+def _write_all(fd: int, data: bytes):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+@functools.lru_cache(maxsize=None)
+def _txt_location(video_id: str) -> tuple[str, str]:
+    """(subfolder, txt file name) of a video, e.g. "landscape/video.mp4" -> ("landscape", "video.txt").
+    Memoized: the same videos are written again and again."""
+    subdir, _, name = video_id.rpartition("/")
+    return subdir, os.path.splitext(name)[0] + ".txt"
+
+
+def _open_dir(path: Path) -> int:
+    return os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+
+# Octal escapes of /proc/self/mounts fields (space, tab, newline, backslash: \040, \011, \012, \134)
+_MOUNT_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape_mount_field(field: str) -> str:
+    return _MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def filesystem_type(path: Path) -> str | None:
+    """Type of the filesystem holding path (e.g. "ext4", "tmpfs"), from /proc/self/mounts (Linux)."""
+    try:
+        real = os.path.realpath(path)
+        best, best_type = "", None
+        with open("/proc/self/mounts", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = _unescape_mount_field(fields[1])
+                inside = real == mount_point or real.startswith(mount_point.rstrip("/") + "/")
+                if inside and len(mount_point) >= len(best):
+                    best, best_type = mount_point, fields[2]
+        return best_type
+    except OSError:
+        return None
+
+
+def _write_tmp(dir_fd: int, txt_name: str, content: bytes, suffix: str = ".tmp") -> int:
+    """Write content to the tmp file of txt_name (txt_name + suffix) in a directory, not yet synced.
+    Returns its fd."""
+    fd = os.open(txt_name + suffix, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644,
+                 dir_fd=dir_fd)
+    try:
+        _write_all(fd, content)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _write_synced_tmp(dir_fd: int, txt_name: str, content: bytes, sync: bool = True, suffix: str = ".tmp"):
+    """Write and fsync (unless sync is False) the tmp file of txt_name in a directory."""
+    fd = _write_tmp(dir_fd, txt_name, content, suffix)
+    try:
+        if sync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _same_content(dir_fd: int, txt_name: str, content: bytes) -> bool:
+    """True if txt_name in a directory already holds exactly content."""
+    try:
+        fd = os.open(txt_name, os.O_RDONLY | os.O_CLOEXEC, dir_fd=dir_fd)
+    except OSError:
+        return False
+    try:
+        return os.fstat(fd).st_size == len(content) and os.read(fd, len(content) + 1) == content
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def _open_txt_dir(path: Path) -> tuple[int, bool]:
+    """(fd, atomic) of a folder of .txt files. atomic is False if the folder is on one of the
+    DIRECT_WRITE_FILESYSTEMS, checked per folder: a subfolder may be a symlink or a mount
+    onto another filesystem than the data folder."""
+    fs_type = filesystem_type(path)
+    atomic = fs_type not in DIRECT_WRITE_FILESYSTEMS
+    if not atomic:
+        print(f"{path} is on {fs_type}: writing its .txt files in place")
+    return _open_dir(path), atomic
+
+
+def _write_files(jobs: list, pool: ThreadPoolExecutor, uring: IoUringWriter, sync: bool, suffix: str):
+    """Write (and sync) `txt_name + suffix` for each job of write_video_txts. Returns one error
+    (or None) per job."""
+    if uring is not None:
+        try:
+            return uring.write_synced_tmps([(job[2], job[3], job[4]) for job in jobs], sync, suffix)
+        except OSError as e:
+            print(f"io_uring failed, writing with threads instead: {e}")
+
+    def write(job):
+        try:
+            _write_synced_tmp(job[2], job[3], job[4], sync, suffix)
+        except OSError as e:
+            return e
+
+    return list((pool.map if pool else map)(write, jobs))
+
+
+def _discard_tmp(dir_fd: int, txt_name: str):
+    """Remove the tmp file of a failed write, if any."""
+    try:
+        os.unlink(txt_name + ".tmp", dir_fd=dir_fd)
+    except OSError:
+        pass
+
+
+def write_video_txts(videos_dir: Path, contents: dict[str, bytes], dir_fds: dict[str, tuple[int, bool]],
+                     pool: ThreadPoolExecutor = None, uring: IoUringWriter = None, sync: bool = True,
+                     force: set = frozenset()) -> set[str]:
+    """Write the .txt files of several videos ({video_id: content}).
+    Batched: all tmp files are written and synced first, then renamed,
+    and each touched directory is synced once at the end.
+    Files are addressed relative to directory fds, cached in dir_fds (subfolder -> (fd, atomic))
+    across calls, so paths are not resolved again for every file.
+    In a folder where atomic is False (see _open_txt_dir), the .txt files are written
+    in place, without tmp file, rename nor fsync.
+    pool: if given, tmp files are written concurrently (fsync releases the GIL,
+    so the device gets several requests in flight).
+    uring: if given, tmp files are written through io_uring instead (see writer_io_uring.py).
+    sync: False to skip all fsyncs (see DURABILITY_MODES).
+    force: video ids written even if their file is up to date (retry of a failed write:
+           the file may be in place but not synced).
+    Returns the video ids whose file could not be written (or synced)."""
+    failed_dirs = set()
+    failed_videos = set()
+
+    def failed(video_id, subdir, e):
+        print(f"Writing categories failed for {video_id}: {e}")
+        failed_dirs.add(subdir)
+        failed_videos.add(video_id)
+
+    # 1. Locate all files (directory fds are opened here, not in the workers)
+    #    and drop those already up to date (e.g. an edit undone within the same pass)
+    jobs = {True: [], False: []}  # atomic -> jobs
+    for video_id, content in contents.items():
+        subdir, txt_name = _txt_location(video_id)
+        try:
+            entry = dir_fds.get(subdir)
+            if entry is None:
+                entry = dir_fds[subdir] = _open_txt_dir(videos_dir / subdir)
+            dir_fd, atomic = entry
+            if video_id in force or not _same_content(dir_fd, txt_name, content):
+                jobs[atomic].append((video_id, subdir, dir_fd, txt_name, content))
+        except OSError as e:
+            failed(video_id, subdir, e)
+
+    # 2. Write and sync all tmp files (in place files: just write them)
+    synced = []
+    for atomic, group in jobs.items():
+        if not group:
+            continue
+        errors = _write_files(group, pool, uring, sync and atomic, ".tmp" if atomic else "")
+        for job, error in zip(group, errors):
+            if error is not None:
+                failed(job[0], job[1], error)
+                if atomic:
+                    _discard_tmp(job[2], job[3])
+            elif atomic:
+                synced.append(job)
+
+    # 3. Rename into place, then sync each directory once
+    touched = {}  # subdir -> (dir fd, [video ids renamed into it])
+    for video_id, subdir, dir_fd, txt_name, _ in synced:
+        try:
+            os.replace(txt_name + ".tmp", txt_name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+            touched.setdefault(subdir, (dir_fd, []))[1].append(video_id)
+        except OSError as e:
+            failed(video_id, subdir, e)
+            _discard_tmp(dir_fd, txt_name)
+    for subdir, (dir_fd, renamed) in touched.items() if sync else ():
+        try:
+            os.fsync(dir_fd)
+        except OSError as e:
+            print(f"Syncing directory failed for {videos_dir / subdir}: {e}")
+            failed_dirs.add(subdir)
+            failed_videos.update(renamed)
+
+    # Reopen the directories that had errors next time (they may have been moved or recreated)
+    for subdir in failed_dirs:
+        entry = dir_fds.pop(subdir, None)
+        if entry is not None:
+            os.close(entry[0])
+    return failed_videos
+
+
+class CommandQueue:
+    """Commands from the request handlers to the writer task (single producer: the event loop,
+    single consumer: writer_loop). A deque plus an Event: put() is an append, with none
+    of asyncio.Queue's per-item futures and wakeups.
+    close() tells the writer to write what is left and stop (see writer_loop)."""
+
+    def __init__(self):
+        self._items = deque()
+        self._ready = asyncio.Event()
+        self.closed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        self._items.append(item)
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def get_many(self, timeout: float, max_items: int) -> list:
+        """Wait for an item, then for `timeout` more seconds so that the items following it
+        are collected in the same batch. Returns at most max_items, in order.
+        Once closed, returns at once (possibly an empty list)."""
+        while not self._items and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+        if len(self._items) < max_items and not self.closed:
+            await asyncio.sleep(timeout)
+        items = self._items
+        batch = [items.popleft() for _ in range(min(max_items, len(items)))]
+        if not items and not self.closed:
+            self._ready.clear()
+        return batch
+
+
+async def writer_loop(state, queue: CommandQueue, videos_dir: Path):
+    """Background task writing .txt files for the videos modified through the API.
+    Request handlers update `state` themselves (same process): SET / SET_PERFORMERS
+    only mark a video as modified, SNAPSHOT asks for the modified videos to be written.
+    A SNAPSHOT carries the state version ("epoch") it was sent at: it is ignored if a pass
+    already wrote that version or a later one.
+    The videos of a pass whose file could not be written (or that raised) are written
+    again RETRY_SECONDS later, so the task never dies nor forgets an edit. Once the queue is closed, a last pass writes every pending
+    video and the task returns."""
+    loop = asyncio.get_running_loop()
+    durability = os.environ.get("FRVM_DURABILITY", "fsync")
+    if durability not in DURABILITY_MODES:
+        print(f"Unknown FRVM_DURABILITY {durability!r}, using 'fsync'")
+        durability = "fsync"
+    sync = durability == "fsync"
     pending_videos = set()  # Videos modified since last snapshot
-    
-    while True:
-        cmd = queue.get()
-
-        if cmd["type"] == "SET":
-            video_id = cmd["video_id"]
-            idx = state.video_index[video_id]
-            emoji = cmd["category"]
-            state.add_category(emoji)
-            state.extend_category(emoji)
-
-            cat = state.categories[emoji]
-            cat["yes"][idx] = cmd["state"] == "YES"
-            cat["no"][idx] = cmd["state"] == "NO"
-            
-            pending_videos.add(video_id)
-
-        elif cmd["type"] == "SET_PERFORMERS":
-            video_id = cmd["video_id"]
-            idx = state.video_index[video_id]
-            performers = cmd["performers"]  # list of performer names
-            
-            # Clear all performer bits for this video, then set the new ones
-            for name, bits in state.performers.items():
-                bits[idx] = (name in performers)
-            
-            pending_videos.add(video_id)
-
-        elif cmd["type"] == "SNAPSHOT":
-            # Write .txt files for all modified videos
-            for video_id in pending_videos:
-                export_video_txt(state, video_id, videos_dir)
-            pending_videos.clear()
+    flushed_epoch = -1  # state version written by the last pass
+    buf = bytearray()  # render buffer, reused for every video
+    dir_fds = {}  # subfolder -> (open directory fd, atomic), see write_video_txts
+    pool = ThreadPoolExecutor(WRITE_WORKERS, thread_name_prefix="txt-writer")
+    uring = None  # thread pool unless FRVM_IO_URING=1 (see writer_io_uring.py)
+    if os.environ.get("FRVM_IO_URING") == "1":
+        try:
+            uring = IoUringWriter()
+            print("Writing .txt files with io_uring")
+        except OSError as e:
+            print(f"io_uring unavailable ({e}), writing .txt files with threads")
+
+    failed_videos = set()  # videos of the last pass that could not be written: retried
+    retry = False  # last pass failed: write its videos again, even without new commands
+    try:
+        while True:
+            # N edits of the same video in a burst end up in a single write
+            try:
+                cmds = await asyncio.wait_for(queue.get_many(DEBOUNCE_SECONDS, MAX_BATCH),
+                                              RETRY_SECONDS if retry else None)
+            except asyncio.TimeoutError:
+                cmds = []
+
+            snapshot = retry or queue.closed
+            for cmd in cmds:
+                kind = cmd["type"]
+                if kind == "SNAPSHOT":
+                    if cmd.get("epoch", flushed_epoch + 1) > flushed_epoch:
+                        snapshot = True
+                elif kind == "SET" or kind == "SET_PERFORMERS":
+                    pending_videos.add(cmd["video_id"])
+
+            # Write only if something changed since the last pass
+            if snapshot and pending_videos:
+                # Render on the event loop (consistent view of state), write in a thread
+                epoch = state.version
+                batch, pending_videos = pending_videos, set()
+                try:
+                    state.load_video_categories([state.video_index[video_id] for video_id in batch])
+                    contents = {video_id: render_video_txt(state, video_id, buf) for video_id in batch}
+                    failed_videos = await loop.run_in_executor(None, write_video_txts, videos_dir, contents,
+                                                               dir_fds, pool, uring, sync, failed_videos & batch)
+                except Exception as e:
+                    print(f"Writing .txt files failed ({len(batch)} videos): {e!r}")
+                    failed_videos = batch
+                if failed_videos:
+                    print(f"Retrying {len(failed_videos)} videos in {RETRY_SECONDS}s")
+                    pending_videos |= failed_videos
+                    retry = True
+                else:
+                    flushed_epoch = epoch
+                    retry = False
+                if uring is not None and uring.failed:
+                    uring = None  # ring error (see IoUringWriter): threads from now on
+
+            if queue.closed and not len(queue):
+                if pending_videos:
+                    print(f"Writer stopped, {len(pending_videos)} videos not written")
+                return
+    finally:
+        if uring is not None:
+            uring.close()
+        pool.shutdown()
+        for dir_fd, _ in dir_fds.values():
+            os.close(dir_fd)
@@ -0,0 +1,101 @@
+"""
+Optional io_uring backend for writer.py (Linux only, needs `pip install liburing`,
+enabled with FRVM_IO_URING=1).
+The writes and fsyncs of a whole pass are submitted with a single io_uring_enter(),
+each fsync linked to the write of its file (IOSQE_IO_LINK) so it only runs after it.
+"""
+
+import os
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+# Submission queue size: a file takes 2 entries (write + fsync)
+RING_ENTRIES = 256
+
+
+class IoUringWriter:
+    """Writes and syncs tmp files through an io_uring. Raises OSError if io_uring is unavailable.
+    After an error of the ring itself, `failed` is set and the writer must not be used again."""
+
+    def __init__(self, entries: int = RING_ENTRIES):
+        if liburing is None:
+            raise OSError("liburing is not installed")
+        self.entries = entries
+        self.ring = liburing.Ring()
+        self.cqe = liburing.Cqe()
+        self.failed = False
+        self._abandoned = []  # jobs of a failed batch: the kernel may still read their buffers
+        liburing.io_uring_queue_init(entries, self.ring)  # OSError if disabled by the kernel
+
+    def close(self):
+        if not self.failed:
+            liburing.io_uring_queue_exit(self.ring)
+
+    def write_synced_tmps(self, jobs: list, sync: bool = True, suffix: str = ".tmp") -> list:
+        """Write and fsync (unless sync is False) `name + suffix` for each (dir_fd, name, content) job.
+        Returns one OSError (or None on success) per job.
+        Raises OSError if the ring itself fails: then no job of the call can be trusted
+        to be written, and `failed` is set."""
+        if self.failed:
+            raise OSError("io_uring writer disabled after an earlier error")
+        errors = [None] * len(jobs)
+        per_batch = self.entries // 2
+        for start in range(0, len(jobs), per_batch):
+            self._run_batch(jobs, start, min(start + per_batch, len(jobs)), errors, sync, suffix)
+        return errors
+
+    def _run_batch(self, jobs: list, start: int, end: int, errors: list, sync: bool, suffix: str):
+        ring = self.ring
+        fds = {}  # job index -> tmp fd
+        try:
+            for i in range(start, end):
+                dir_fd, name, content = jobs[i]
+                try:
+                    fds[i] = os.open(name + suffix, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+                                     0o644, dir_fd=dir_fd)
+                except OSError as e:
+                    errors[i] = e
+                    continue
+                # user_data: 2*i for the write, 2*i+1 for the fsync.
+                # jobs keeps `content` alive until completion.
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_write(sqe, fds[i], content, 0)
+                sqe.user_data = 2 * i
+                # Set even when 0: the binding may hand back an entry with the flags of its last use
+                liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_IO_LINK if sync else 0)
+                if sync:
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_fsync(sqe, fds[i])
+                    sqe.user_data = 2 * i + 1
+            if not fds:
+                return
+
+            expected = (2 if sync else 1) * len(fds)
+            cqe = self.cqe
+            try:
+                liburing.io_uring_submit_and_wait(ring, expected)
+                for _ in range(expected):
+                    # One completion at a time: the binding's cqe[k] for k > 0 does not wrap around the ring
+                    liburing.io_uring_wait_cqe(ring, cqe)
+                    entry = cqe[0]  # not cached by the binding: read once
+                    i, is_fsync = divmod(entry.user_data, 2)
+                    try:
+                        res = entry.res  # raises OSError for a failed (or cancelled) operation
+                    except OSError as e:
+                        res = None
+                        errors[i] = errors[i] or e
+                    liburing.io_uring_cq_advance(ring, 1)
+                    if not is_fsync and res is not None and res != len(jobs[i][2]):
+                        errors[i] = errors[i] or OSError(f"short write ({res} of {len(jobs[i][2])} bytes)")
+            except OSError:
+                # EINTR, EBUSY...: entries may be left unsubmitted and completions still due,
+                # so the ring is never used (nor torn down) again
+                self.failed = True
+                self._abandoned.append(jobs)
+                raise
+        finally:
+            for fd in fds.values():
+                os.close(fd)